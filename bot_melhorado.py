@@ -1,23 +1,44 @@
 import os
 import re
-import xml.etree.ElementTree as ET
+from lxml import etree
 from datetime import datetime, timedelta
 import gspread
 from google.oauth2.service_account import Credentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PicklePersistence, PersistenceInput, AIORateLimiter
 import pytesseract
 from PIL import Image, ImageEnhance
+import cv2
+import numpy as np
+# O paralelismo do OCR é por página/foto (_OCR_POOL); sem isto cada Tesseract
+# ainda abre suas próprias threads OpenMP e disputa a CPU com as outras.
+# Precisa estar no ambiente antes do Tesseract ser carregado.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+try:
+    import tesserocr
+except ImportError:  # Sem tesserocr (ex.: Windows), segue com pytesseract
+    tesserocr = None
 import io
 import asyncio
-from pdf2image import convert_from_bytes
+import functools
+import time
+import threading
+from pdf2image import convert_from_path
+import pypdf
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import json
+import orjson
+import logging
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 import platform
+import hashlib
+import tempfile
+import diskcache
 
 # Configurar Tesseract apenas no Windows
 if platform.system() == 'Windows':
@@ -35,6 +56,10 @@ if not TELEGRAM_TOKEN:
 if not SPREADSHEET_ID:
     raise ValueError("❌ SPREADSHEET_ID não configurado no .env ou variáveis de ambiente")
 
+# Estado de cada usuário (upload em andamento) persistido entre reinícios
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_data.pickle")
+SESSAO_TTL = 10 * 60  # segundos sem interação até a sessão ser descartada
+
 CNPJ_LDL = "60415819000141"
 CNPJ_POP = "61081232000106"
 
@@ -43,7 +68,89 @@ CATEGORIAS_DESPESAS = [
     "AFRMM", "SISCOMEX", "ICMS", "Seguro", "Inspeção", "Certificação", "Outros"
 ]
 
-user_data_temp = {}
+# Categorias (menos "Outros") já em maiúsculas, para a busca na descrição do /despesa
+_CATEGORIAS_UPPER = tuple((cat, cat.upper()) for cat in CATEGORIAS_DESPESAS[:-1])
+
+# Teclados fixos, montados uma vez (InlineKeyboardMarkup é imutável e pode ser reaproveitado)
+_CAT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(CATEGORIAS_DESPESAS[i+j], callback_data=f"cat_{i+j}")
+     for j in range(2) if i + j < len(CATEGORIAS_DESPESAS)]
+    for i in range(0, len(CATEGORIAS_DESPESAS), 2)
+])
+_BOTAO_CANCELAR = InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")
+_CANCELAR_KB = InlineKeyboardMarkup([[_BOTAO_CANCELAR]])
+
+def _confirmar_cancelar(texto, callback_data):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(texto, callback_data=callback_data)], [_BOTAO_CANCELAR]])
+
+_CONFIRMAR_ZIP_KB = _confirmar_cancelar("✅ Confirmar", "confirmar_zip")
+_CONFIRMAR_XML_KB = _confirmar_cancelar("✅ Confirmar", "confirmar_xml")
+_CONFIRMAR_DESPESA_KB = _confirmar_cancelar("✅ Confirmar", "confirmar_despesa")
+_FORCAR_XML_KB = _confirmar_cancelar("✅ Adicionar mesmo assim", "forcar_xml")
+_FORCAR_DESPESA_KB = _confirmar_cancelar("✅ Adicionar mesmo assim", "forcar_despesa")
+
+# Padrões de regex compilados uma vez na importação
+_VALORES_COMBINED = re.compile(
+    r'(?:(?:TOTAL|VALUE|VALOR|BRL)[:\s]+(?:BRL\s+)?|R\$\s*|(?:BRL|USD)\s+)?'
+    r'(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
+    re.IGNORECASE
+)
+_DATA_PATTERNS = [re.compile(p) for p in (
+    r'(\d{2}[/.-]\d{2}[/.-]\d{4})',
+    r'(\d{2}[/.-]\d{2}[/.-]\d{2})',
+    r'(\d{4}[/.-]\d{2}[/.-]\d{2})',
+)]
+# Sem diferenciar maiúsculas: evita copiar o texto inteiro com .upper() a cada chamada
+_PI_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (
+    r'PI[:\s]*([A-Z0-9]+)',
+    r'PROCESSO[:\s]*([A-Z0-9]+)',
+    r'([A-Z]{4}\d{7})',
+)]
+# Também cobre "TAXA SISCOMEX ...", que contém o mesmo trecho
+_SISCOMEX_RE = re.compile(r'SISCOMEX\s+(?:FOI\s+DE\s+)?R?\$?\s*(\d{1,3}(?:\.\d{3})*,\d{2})', re.IGNORECASE)
+
+# Palavras-chave de extrair_descricao, em ordem de prioridade da categoria
+_DESCRICAO_CATEGORIAS = [
+    (('FRETE', 'FREIGHT', 'SHIPPING', 'OCEAN'), 'Frete'),
+    (('ARMAZEN', 'STORAGE'), 'Armazenagem'),
+    (('DESPACH', 'CUSTOMS'), 'Despachante'),
+    (('AFRMM',), 'AFRMM'),
+    (('SISCOMEX',), 'SISCOMEX'),
+]
+_DESCRICAO_PRIORIDADE = {kw: i for i, (kws, _) in enumerate(_DESCRICAO_CATEGORIAS) for kw in kws}
+# Lookahead para não consumir caracteres: em 'CUSTOMSHIPPING', 'CUSTOMS' não pode esconder 'SHIPPING'.
+# re.ASCII: o trecho casado sempre volta para a chave com .upper() (ex.: 'İ' não casa com 'I')
+_DESCRICAO_RE = re.compile('(?=(%s))' % '|'.join(map(re.escape, _DESCRICAO_PRIORIDADE)), re.IGNORECASE | re.ASCII)
+
+# Chamadas ao Google Sheets saem do event loop por um pool limitado,
+# que só limita quantas rodam ao mesmo tempo (não controla a cota por minuto da API)
+SHEETS_MAX_WORKERS = 8
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix='sheets')
+
+# Cliente, planilha e abas abertos uma única vez por processo
+# (renovados a cada PLANILHA_REAUTH_APOS segundos; o token do Google dura ~1h)
+PLANILHA_REAUTH_APOS = 50 * 60
+_PLANILHA_CACHE = {'client': None, 'planilha': None, 'worksheets': {}, 'conectado_em': 0.0}
+_PLANILHA_LOCK = threading.Lock()
+
+# Índice em memória dos números de NF já lançados (coluna B) por aba
+ABAS_XML = ['Importacao', 'Saida_1', 'Saida_2']
+NFS_CACHE_TTL = 60  # segundos
+_NFS_CONHECIDAS = {'carregado_em': 0.0, 'abas': {}}
+# Recarga e registro não podem se cruzar: a recarga segura o lock na leitura e na troca,
+# então uma gravação que termina no meio espera e é registrada no índice novo
+_NFS_LOCK = threading.Lock()
+
+# Linhas de 'outras_despesas' agrupadas por PI, já convertidas (data e valor);
+# recarregado em segundo plano para pegar edições feitas direto na planilha
+DESPESAS_REFRESH_INTERVALO = 10 * 60  # segundos
+_DESPESAS_POR_PI = {'carregado_em': 0.0, 'pis': None}
+_DESPESAS_LOCK = threading.Lock()  # mesma regra do _NFS_LOCK
+
+# Despesas confirmadas em sequência são agrupadas numa única escrita
+ESCRITA_LOTE_INTERVALO = 0.2  # segundos
+ESCRITA_LOTE_MAX = 50
+_FILA_DESPESAS = {'fila': None, 'tarefa': None}
 
 # ==================== GOOGLE SHEETS - CONEXÃO MELHORADA ====================
 
@@ -51,7 +158,23 @@ def conectar_planilha():
     """
     Conecta ao Google Sheets usando Service Account.
     Prioriza variável de ambiente (produção) e fallback para arquivo local (dev).
+    A conexão é reaproveitada nas chamadas seguintes e refeita depois de
+    PLANILHA_REAUTH_APOS segundos ou de um erro da API (invalidar_planilha).
     """
+    if _conexao_valida():
+        return _PLANILHA_CACHE['planilha']
+    
+    with _PLANILHA_LOCK:
+        # Outra thread pode ter conectado enquanto esta esperava o lock
+        if _conexao_valida():
+            return _PLANILHA_CACHE['planilha']
+        return _conectar_planilha()
+
+def _conexao_valida():
+    return (_PLANILHA_CACHE['planilha'] is not None
+            and time.monotonic() - _PLANILHA_CACHE['conectado_em'] < PLANILHA_REAUTH_APOS)
+
+def _conectar_planilha():
     try:
         scopes = [
             'https://www.googleapis.com/auth/spreadsheets',
@@ -62,15 +185,15 @@ def conectar_planilha():
         credentials_json = os.getenv("CREDENTIALS_JSON")
         
         if credentials_json:
-            print("[DEBUG] 🔐 Usando credenciais da variável de ambiente")
+            log.debug("🔐 Usando credenciais da variável de ambiente")
             try:
-                creds_dict = json.loads(credentials_json)
+                creds_dict = orjson.loads(credentials_json)
                 creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 raise ValueError(f"❌ CREDENTIALS_JSON inválido: {e}")
         else:
             # Fallback: arquivo local (DESENVOLVIMENTO)
-            print("[DEBUG] 🔐 Usando credenciais do arquivo local")
+            log.debug("🔐 Usando credenciais do arquivo local")
             if not os.path.exists("credentials.json"):
                 raise FileNotFoundError(
                     "❌ Arquivo credentials.json não encontrado e CREDENTIALS_JSON não configurado.\n"
@@ -82,7 +205,13 @@ def conectar_planilha():
         client = gspread.authorize(creds)
         planilha = client.open_by_key(SPREADSHEET_ID)
         
-        print(f"[DEBUG] ✅ Conectado à planilha: {planilha.title}")
+        _PLANILHA_CACHE['client'] = client
+        _PLANILHA_CACHE['planilha'] = planilha
+        # Handles de todas as abas de uma vez (uma requisição, em vez de uma por aba)
+        _PLANILHA_CACHE['worksheets'] = {aba.title: aba for aba in planilha.worksheets()}
+        _PLANILHA_CACHE['conectado_em'] = time.monotonic()
+        
+        log.info("✅ Conectado à planilha: %s (%d abas)", planilha.title, len(_PLANILHA_CACHE['worksheets']))
         return planilha
         
     except gspread.exceptions.SpreadsheetNotFound:
@@ -97,6 +226,56 @@ def conectar_planilha():
     except Exception as e:
         raise ValueError(f"❌ Erro ao conectar planilha: {e}")
 
+def invalidar_planilha():
+    """Descarta a conexão em cache; a próxima chamada autentica de novo"""
+    with _PLANILHA_LOCK:
+        _PLANILHA_CACHE['planilha'] = None
+        _PLANILHA_CACHE['worksheets'] = {}
+
+def com_reconexao(func):
+    """
+    Se a API do Google recusar a autenticação (401/403: token expirado ou
+    revogado), descarta a conexão em cache, reconecta e tenta mais uma vez.
+    Demais erros (400, 429, 5xx) sobem sem mexer na conexão.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in (401, 403):
+                raise
+            log.warning("Autenticação do Google recusada, reconectando: %s", e)
+            invalidar_planilha()
+            return func(*args, **kwargs)
+    return wrapper
+
+def linha_gravada(resposta):
+    """Número da primeira linha escrita, lido da resposta de um append"""
+    try:
+        inicio = resposta['updates']['updatedRange'].split('!')[-1].split(':')[0]
+        return gspread.utils.a1_to_rowcol(inicio)[0]
+    except Exception:
+        return None
+
+def obter_aba(nome_aba):
+    """Retorna a aba pelo nome, reaproveitando o handle já aberto"""
+    planilha = conectar_planilha()
+    abas = _PLANILHA_CACHE['worksheets']
+    if nome_aba not in abas:
+        abas[nome_aba] = planilha.worksheet(nome_aba)
+    return abas[nome_aba]
+
+@com_reconexao
+def anexar_linhas(nome_aba, linhas):
+    """append_rows na aba indicada"""
+    return obter_aba(nome_aba).append_rows(linhas)
+
+async def em_sheets(func, *args):
+    """Executa uma função bloqueante do gspread no pool do Sheets"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SHEETS_POOL, functools.partial(func, *args))
+
 # ==================== FUNÇÕES AUXILIARES ====================
 
 def normalizar_data(data_str):
@@ -140,9 +319,35 @@ def normalizar_data(data_str):
             continue
     
     # Se nenhum formato funcionar, retorna data atual
-    print(f"[AVISO] Formato de data não reconhecido: {data_str}. Usando data atual.")
+    log.warning("Formato de data não reconhecido: %s. Usando data atual.", data_str)
     return datetime.now().strftime('%d/%m/%Y')
 
+_LIMPAR_VALOR = str.maketrans('', '', ' R$')
+
+def _parse_valor(valor_str):
+    """Normaliza os separadores e converte; retorna None se não for número"""
+    # Remove "R$" e espaços numa única passada
+    valor_str = str(valor_str).strip().translate(_LIMPAR_VALOR)
+    
+    # O separador que aparece por último é o decimal
+    ultima_virgula = valor_str.rfind(',')
+    ultimo_ponto = valor_str.rfind('.')
+    if ultima_virgula > ultimo_ponto:
+        if ultimo_ponto >= 0 or len(valor_str) - ultima_virgula == 3:
+            # Formato: 1.234,56 (brasileiro) ou 1234,56
+            valor_str = valor_str.replace('.', '').replace(',', '.')
+        else:
+            # Só vírgula sem 2 casas decimais: é separador de milhar
+            valor_str = valor_str.replace(',', '')
+    elif ultima_virgula >= 0:
+        # Formato: 1,234.56 (americano)
+        valor_str = valor_str.replace(',', '')
+    
+    try:
+        return float(valor_str)
+    except ValueError:
+        return None
+
 def converter_valor_para_float(valor_str):
     """
     Converte string de valor em float
@@ -151,124 +356,159 @@ def converter_valor_para_float(valor_str):
     if not valor_str:
         return 0.0
     
-    valor_str = str(valor_str).strip()
-    
-    # Remover "R$"
-    valor_str = valor_str.replace('R$', '').strip()
-    
-    # Detectar qual é o separador decimal
-    # Se tem vírgula E ponto, o último é decimal
-    if ',' in valor_str and '.' in valor_str:
-        if valor_str.rfind(',') > valor_str.rfind('.'):
-            # Formato: 1.234,56 (brasileiro)
-            valor_str = valor_str.replace('.', '').replace(',', '.')
-        else:
-            # Formato: 1,234.56 (americano)
-            valor_str = valor_str.replace(',', '')
-    elif ',' in valor_str:
-        # Só tem vírgula: 1234,56 ou 1,56
-        if valor_str.count(',') == 1:
-            # Verificar se é separador de milhar ou decimal
-            partes = valor_str.split(',')
-            if len(partes[1]) == 2:  # Se tem 2 casas após vírgula, é decimal
-                valor_str = valor_str.replace(',', '.')
-            else:
-                # É separador de milhar
-                valor_str = valor_str.replace(',', '')
-    
-    try:
-        return float(valor_str)
-    except:
-        print(f"[ERRO] Não consegui converter: {valor_str}")
+    valor = _parse_valor(valor_str)
+    if valor is None:
+        log.error("Não consegui converter: %s", valor_str)
         return 0.0
+    return valor
 
 # ==================== OCR E PROCESSAMENTO ====================
 
-def extrair_texto_imagem(image_bytes, is_pdf=False):
+# Threads fixas para o OCR (páginas de PDF e fotos): cada uma mantém sua própria
+# instância do Tesseract carregada (PyTessBaseAPI não é thread-safe)
+# Cada thread carrega um modelo por+eng próprio; em container os.cpu_count() costuma
+# mostrar as CPUs do host, então o limite é fixo e configurável
+OCR_MAX_WORKERS = max(1, int(os.getenv("OCR_MAX_WORKERS", "2")))
+_OCR_POOL = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix='ocr')
+_TESS_LOCAL = threading.local()
+# Pasta dos modelos (.traineddata); sem a variável, usa o caminho padrão do Tesseract
+TESSDATA_DIR = os.getenv("TESSDATA_PREFIX")
+
+def _tesseract_api(psm):
+    """Retorna a API do Tesseract da thread atual, carregando o modelo só na primeira vez"""
+    api = getattr(_TESS_LOCAL, 'api', None)
+    if api is None:
+        opcoes = {'path': TESSDATA_DIR} if TESSDATA_DIR else {}
+        api = tesserocr.PyTessBaseAPI(lang='por+eng', oem=tesserocr.OEM.DEFAULT, **opcoes)
+        _TESS_LOCAL.api = api
+    api.SetPageSegMode(psm)
+    return api
+
+def _ocr_pagina_pdf(image):
+    """OCR de uma página do PDF (já renderizada em tons de cinza)"""
+    enhancer = ImageEnhance.Contrast(image)
+    image = enhancer.enhance(2.5)
+    enhancer = ImageEnhance.Sharpness(image)
+    image = enhancer.enhance(2.0)
+    if tesserocr:
+        api = _tesseract_api(tesserocr.PSM.SINGLE_BLOCK)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+    config = '--psm 6 --oem 3'
+    return pytesseract.image_to_string(image, lang='por+eng', config=config)
+
+def _ocr_foto(image):
+    """OCR de uma foto de comprovante já binarizada (array do OpenCV)"""
+    # Comprovante fotografado: texto esparso, sem ordem de leitura fixa
+    if tesserocr:
+        api = _tesseract_api(tesserocr.PSM.SPARSE_TEXT)
+        api.SetImage(Image.fromarray(image))
+        return api.GetUTF8Text()
+    config = '--psm 11 --oem 3'
+    return pytesseract.image_to_string(image, lang='por+eng', config=config)
+
+# Abaixo disso a camada de texto do PDF é considerada vazia (PDF escaneado)
+PDF_TEXTO_MIN_CHARS = 50
+
+def extrair_texto_pdf(caminho):
+    """Lê a camada de texto embutida do PDF (PDFs gerados por sistema), sem OCR"""
+    try:
+        leitor = pypdf.PdfReader(caminho)
+        return "\n".join(pagina.extract_text() or "" for pagina in leitor.pages)
+    except Exception as e:
+        log.warning("Não consegui ler o texto do PDF, usando OCR: %s", e)
+        return ""
+
+# Texto já extraído, por conteúdo do arquivo: o mesmo comprovante reenviado não passa pelo OCR de novo
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ocr_cache"))
+_OCR_CACHE = diskcache.Cache(OCR_CACHE_DIR, size_limit=500 * 1024 * 1024)
+
+def _hash_arquivo(caminho, bloco=1024 * 1024):
+    h = hashlib.blake2b(digest_size=16)
+    with open(caminho, 'rb') as f:
+        for pedaco in iter(lambda: f.read(bloco), b''):
+            h.update(pedaco)
+    return h.digest()
+
+def cache_ocr(func):
+    """Memoiza o texto extraído em disco, pela hash (blake2b) do conteúdo do arquivo"""
+    @functools.wraps(func)
+    def wrapper(caminho, is_pdf=False):
+        chave = (_hash_arquivo(caminho), is_pdf)
+        texto = _OCR_CACHE.get(chave)
+        if texto is not None:
+            log.debug("OCR em cache")
+            return texto
+        texto = func(caminho, is_pdf)
+        if texto:  # "" indica falha no OCR; não guarda para tentar de novo
+            _OCR_CACHE.set(chave, texto)
+        return texto
+    return wrapper
+
+@cache_ocr
+def extrair_texto_imagem(caminho, is_pdf=False):
+    """OCR do arquivo salvo em disco (foto ou PDF)"""
     try:
         if is_pdf:
-            print("[DEBUG] Convertendo PDF...")
+            texto_pdf = extrair_texto_pdf(caminho)
+            if len(texto_pdf.strip()) > PDF_TEXTO_MIN_CHARS:
+                log.debug("Texto PDF (camada de texto): %.200s...", texto_pdf)
+                return texto_pdf + "\n"
+            log.debug("Convertendo PDF...")
             poppler_path = r'C:\poppler\Library\bin' if platform.system() == 'Windows' else None
-            images = convert_from_bytes(image_bytes, poppler_path=poppler_path, dpi=300)
-            texto_completo = ""
-            for i, image in enumerate(images):
-                print(f"[DEBUG] Página {i+1}...")
-                image = image.convert('L')
-                enhancer = ImageEnhance.Contrast(image)
-                image = enhancer.enhance(2.5)
-                enhancer = ImageEnhance.Sharpness(image)
-                image = enhancer.enhance(2.0)
-                config = '--psm 6 --oem 3'
-                texto = pytesseract.image_to_string(image, lang='por+eng', config=config)
-                texto_completo += texto + "\n"
-            print(f"[DEBUG] Texto PDF: {texto_completo[:200]}...")
+            images = convert_from_path(caminho, poppler_path=poppler_path, dpi=200, grayscale=True,
+                                       use_pdftocairo=True, thread_count=OCR_MAX_WORKERS)
+            log.debug("%d página(s)...", len(images))
+            # O Tesseract libera o GIL, então as páginas podem ser processadas em paralelo
+            textos = list(_OCR_POOL.map(_ocr_pagina_pdf, images))
+            texto_completo = "\n".join(textos) + "\n"
+            log.debug("Texto PDF: %.200s...", texto_completo)
             return texto_completo
         else:
-            image = Image.open(io.BytesIO(image_bytes))
-            image = image.convert('L')
-            width, height = image.size
-            if width < 1500 or height < 1500:
-                image = image.resize((width*2, height*2), Image.LANCZOS)
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(2.5)
-            enhancer = ImageEnhance.Sharpness(image)
-            image = enhancer.enhance(2.0)
-            config = '--psm 6 --oem 3'
-            texto = pytesseract.image_to_string(image, lang='por+eng', config=config)
-            print(f"[DEBUG] Texto: {texto[:200]}...")
+            image = cv2.imread(caminho, cv2.IMREAD_GRAYSCALE)
+            if image is None:  # formato que o OpenCV não lê: decodifica pelo PIL
+                image = np.array(Image.open(caminho).convert('L'))
+            height, width = image.shape
+            if min(width, height) < 1000:
+                image = cv2.resize(image, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+            # Filtro bilateral (tira o ruído da câmera sem borrar as letras)
+            # + contraste local (CLAHE) + binarização adaptativa
+            image = cv2.bilateralFilter(image, d=5, sigmaColor=75, sigmaSpace=75)
+            image = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(image)
+            image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+            texto = _OCR_POOL.submit(_ocr_foto, image).result()
+            log.debug("Texto: %.200s...", texto)
             return texto
     except Exception as e:
-        print(f"[ERRO OCR] {e}")
+        log.exception("Erro no OCR: %s", e)
         return ""
 
 def extrair_valores_texto(texto):
-    padroes = [
-        r'(?:TOTAL|Total|VALUE|Value|VALOR|Valor|BRL)[:\s]+(?:BRL\s+)?(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
-        r'R\$\s*(\d{1,3}(?:\.\d{3})*,\d{2})',
-        r'(?:BRL|USD)\s+(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
-        r'(\d{1,3}(?:\.\d{3})*,\d{2})',
-        r'(\d{1,3}(?:,\d{3})*\.\d{2})'
-    ]
-    valores = []
-    for padrao in padroes:
-        valores.extend(re.findall(padrao, texto, re.IGNORECASE))
-    
-    valores_float = []
-    for v in valores:
-        try:
-            if ',' in v and '.' in v:
-                v_clean = v.replace('.', '').replace(',', '.') if v.rfind(',') > v.rfind('.') else v.replace(',', '')
-            elif ',' in v:
-                v_clean = v.replace('.', '').replace(',', '.') if len(v.split(',')[-1]) == 2 else v.replace(',', '')
-            else:
-                v_clean = v
-            valor_float = float(v_clean)
-            if valor_float > 0 and valor_float not in valores_float:
-                valores_float.append(valor_float)
-        except:
-            continue
-    return sorted(list(set(valores_float)), reverse=True)
+    # Uma única varredura do texto; valores repetidos caem no mesmo elemento do set
+    valores = set()
+    for match in _VALORES_COMBINED.finditer(texto):
+        valor = _parse_valor(match.group(1))
+        if valor and valor > 0:
+            valores.add(valor)
+    return sorted(valores, reverse=True)
 
 def extrair_data(texto):
-    for padrao in [r'(\d{2}[/.-]\d{2}[/.-]\d{4})', r'(\d{2}[/.-]\d{2}[/.-]\d{2})', r'(\d{4}[/.-]\d{2}[/.-]\d{2})']:
-        match = re.search(padrao, texto)
+    for padrao in _DATA_PATTERNS:
+        match = padrao.search(texto)
         if match:
             data_encontrada = match.group(1)
             return normalizar_data(data_encontrada)
     return datetime.now().strftime('%d/%m/%Y')
 
 def extrair_descricao(texto):
-    texto_upper = texto.upper()
-    if any(w in texto_upper for w in ['FRETE', 'FREIGHT', 'SHIPPING', 'OCEAN']):
-        return 'Frete'
-    elif any(w in texto_upper for w in ['ARMAZEN', 'STORAGE']):
-        return 'Armazenagem'
-    elif any(w in texto_upper for w in ['DESPACH', 'CUSTOMS']):
-        return 'Despachante'
-    elif 'AFRMM' in texto_upper:
-        return 'AFRMM'
-    elif 'SISCOMEX' in texto_upper:
-        return 'SISCOMEX'
+    # Uma única varredura do texto; vence a categoria de maior prioridade encontrada
+    melhor = len(_DESCRICAO_CATEGORIAS)
+    for match in _DESCRICAO_RE.finditer(texto):
+        melhor = min(melhor, _DESCRICAO_PRIORIDADE[match.group(1).upper()])
+        if melhor == 0:
+            break
+    if melhor < len(_DESCRICAO_CATEGORIAS):
+        return _DESCRICAO_CATEGORIAS[melhor][1]
     return 'Despesa'
 
 def extrair_dados_comprovante(texto):
@@ -279,107 +519,159 @@ def extrair_dados_comprovante(texto):
         'texto_completo': texto
     }
 
+def ocr_comprovante(caminho, is_pdf=False):
+    """OCR do arquivo e extração dos campos; dados é None quando não sai texto útil"""
+    texto = extrair_texto_imagem(caminho, is_pdf)
+    if not texto or len(texto) < 10:
+        return texto, None
+    return texto, extrair_dados_comprovante(texto)
+
 # ==================== PROCESSAMENTO XML ====================
 
+NFE_NS = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+
+def _xpath(expressao):
+    return etree.XPath(expressao, namespaces=NFE_NS, smart_strings=False)
+
+# Expressões XPath compiladas uma vez. Os blocos (ide, emit, dest, ICMSTot) são
+# localizados uma única vez por XML e os campos lidos como filhos diretos deles
+_XP_IDE = _xpath('(.//nfe:ide)[1]')
+_XP_EMIT = _xpath('(.//nfe:emit)[1]')
+_XP_DEST = _xpath('(.//nfe:dest)[1]')
+_XP_ICMS_TOT = _xpath('(.//nfe:total/nfe:ICMSTot)[1]')
+_XP_II = _xpath('(.//nfe:II/nfe:vII)[1]/text()')
+_XP_AFRMM = _xpath('.//nfe:DI/nfe:vAFRMM/text()')
+_XP_INF_CPL = _xpath('(.//nfe:infCpl)[1]/text()')
+
+def _primeiro(xp, root, default=None):
+    resultado = xp(root)
+    return resultado[0] if resultado else default
+
+def txt(parent, tag, default=''):
+    el = parent.find(tag, NFE_NS)
+    return el.text if el is not None and el.text is not None else default
+
+def num(parent, tag, default=0):
+    el = parent.find(tag, NFE_NS)
+    return float(el.text) if el is not None and el.text else default
+
+def _ler_nfe(root, pi_informada=None):
+    """Extrai os campos da NFe a partir do elemento raiz já parseado"""
+    ide = _primeiro(_XP_IDE, root)
+    emit = _primeiro(_XP_EMIT, root)
+    dest = _primeiro(_XP_DEST, root)
+    total = _primeiro(_XP_ICMS_TOT, root)
+    if ide is None or emit is None or dest is None or total is None:
+        raise ValueError("XML não é uma NFe (faltam ide/emit/dest/total)")
+    
+    dh_emi = txt(ide, 'nfe:dhEmi')
+    dados = {
+        'numero_nf': txt(ide, 'nfe:nNF'),
+        'data_emissao': normalizar_data(dh_emi) if dh_emi else datetime.now().strftime('%d/%m/%Y'),
+        'natureza': txt(ide, 'nfe:natOp'),
+        'cnpj_emitente': txt(emit, 'nfe:CNPJ'),
+        'nome_emitente': txt(emit, 'nfe:xNome'),
+        'cnpj_destinatario': txt(dest, 'nfe:CNPJ'),
+        'nome_destinatario': txt(dest, 'nfe:xNome'),
+        'valor_produtos': num(total, 'nfe:vProd'),
+        'valor_nf': num(total, 'nfe:vNF'),
+        'icms': num(total, 'nfe:vICMS'),
+        'ipi': num(total, 'nfe:vIPI'),
+        'pis': num(total, 'nfe:vPIS'),
+        'cofins': num(total, 'nfe:vCOFINS'),
+        'pi': pi_informada or 'N/A'
+    }
+    
+    try:
+        dados['ii'] = float(_primeiro(_XP_II, root, 0))
+    except:
+        dados['ii'] = 0
+    
+    try:
+        afrmm_total = sum(float(v) for v in _XP_AFRMM(root))
+        dados['afrmm'] = afrmm_total
+        log.debug("AFRMM TOTAL: R$ %s", afrmm_total)
+    except:
+        dados['afrmm'] = 0
+    
+    try:
+        siscomex = 0
+        inf_cpl = _primeiro(_XP_INF_CPL, root)
+        match = _SISCOMEX_RE.search(inf_cpl) if inf_cpl else None
+        if match:
+            siscomex = float(match.group(1).replace('.', '').replace(',', '.'))
+            log.debug("SISCOMEX: R$ %s", siscomex)
+        dados['siscomex'] = siscomex
+    except:
+        dados['siscomex'] = 0
+    
+    return dados
+
 def extrair_dados_xml(xml_content, pi_informada=None):
     try:
-        root = ET.fromstring(xml_content)
-        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-        ide = root.find('.//nfe:ide', ns)
-        emit = root.find('.//nfe:emit', ns)
-        dest = root.find('.//nfe:dest', ns)
-        total = root.find('.//nfe:total/nfe:ICMSTot', ns)
-        
-        dados = {
-            'numero_nf': ide.find('nfe:nNF', ns).text if ide.find('nfe:nNF', ns) is not None else '',
-            'data_emissao': normalizar_data(ide.find('nfe:dhEmi', ns).text) if ide.find('nfe:dhEmi', ns) is not None else datetime.now().strftime('%d/%m/%Y'),
-            'natureza': ide.find('nfe:natOp', ns).text if ide.find('nfe:natOp', ns) is not None else '',
-            'cnpj_emitente': emit.find('nfe:CNPJ', ns).text if emit.find('nfe:CNPJ', ns) is not None else '',
-            'nome_emitente': emit.find('nfe:xNome', ns).text if emit.find('nfe:xNome', ns) is not None else '',
-            'cnpj_destinatario': dest.find('nfe:CNPJ', ns).text if dest.find('nfe:CNPJ', ns) is not None else '',
-            'nome_destinatario': dest.find('nfe:xNome', ns).text if dest.find('nfe:xNome', ns) is not None else '',
-            'valor_produtos': float(total.find('nfe:vProd', ns).text) if total.find('nfe:vProd', ns) is not None else 0,
-            'valor_nf': float(total.find('nfe:vNF', ns).text) if total.find('nfe:vNF', ns) is not None else 0,
-            'icms': float(total.find('nfe:vICMS', ns).text) if total.find('nfe:vICMS', ns) is not None else 0,
-            'ipi': float(total.find('nfe:vIPI', ns).text) if total.find('nfe:vIPI', ns) is not None else 0,
-            'pis': float(total.find('nfe:vPIS', ns).text) if total.find('nfe:vPIS', ns) is not None else 0,
-            'cofins': float(total.find('nfe:vCOFINS', ns).text) if total.find('nfe:vCOFINS', ns) is not None else 0,
-            'pi': pi_informada or 'N/A'
-        }
-        
-        try:
-            dados['ii'] = float(root.find('.//nfe:II/nfe:vII', ns).text) if root.find('.//nfe:II/nfe:vII', ns) is not None else 0
-        except:
-            dados['ii'] = 0
-        
-        try:
-            afrmm_total = 0
-            for di in root.findall('.//nfe:DI', ns):
-                afrmm_elem = di.find('nfe:vAFRMM', ns)
-                if afrmm_elem is not None:
-                    afrmm_total += float(afrmm_elem.text)
-            dados['afrmm'] = afrmm_total
-            print(f"[DEBUG] AFRMM TOTAL: R$ {afrmm_total}")
-        except:
-            dados['afrmm'] = 0
-        
-        try:
-            siscomex = 0
-            inf_cpl = root.find('.//nfe:infCpl', ns)
-            if inf_cpl is not None and inf_cpl.text:
-                texto = inf_cpl.text.upper()
-                for padrao in [r'SISCOMEX\s+(?:FOI\s+DE\s+)?R?\$?\s*(\d{1,3}(?:\.\d{3})*,\d{2})', r'TAXA\s+SISCOMEX\s+(?:FOI\s+DE\s+)?R?\$?\s*(\d{1,3}(?:\.\d{3})*,\d{2})']:
-                    match = re.search(padrao, texto)
-                    if match:
-                        siscomex = float(match.group(1).replace('.', '').replace(',', '.'))
-                        print(f"[DEBUG] SISCOMEX: R$ {siscomex}")
-                        break
-            dados['siscomex'] = siscomex
-        except:
-            dados['siscomex'] = 0
-        
-        return dados
+        # Bytes crus: o lxml respeita o encoding declarado no próprio XML
+        return _ler_nfe(etree.fromstring(xml_content), pi_informada)
+    except Exception as e:
+        log.error("Erro XML: %s", e)
+        return None
+
+def extrair_dados_xml_stream(arquivo, pi_informada=None):
+    """Igual a extrair_dados_xml, mas lendo de um arquivo aberto sem carregá-lo todo"""
+    try:
+        return _ler_nfe(etree.parse(arquivo).getroot(), pi_informada)
     except Exception as e:
-        print(f"Erro XML: {e}")
+        log.error("Erro XML: %s", e)
         return None
 
+def _extrair_xml_do_zip(zip_file, file_name):
+    log.debug("%s...", file_name)
+    with zip_file.open(file_name) as arquivo:
+        return extrair_dados_xml_stream(arquivo)
+
 def processar_zip_xmls(zip_bytes):
     try:
-        print("[DEBUG] Processando ZIP...")
+        log.debug("Processando ZIP...")
         zip_file = zipfile.ZipFile(io.BytesIO(zip_bytes))
         xmls_dados = []
         valor_total = 0
         quantidade_nfs = 0
         remessas_ignoradas = 0
         
-        for file_name in zip_file.namelist():
-            if file_name.lower().endswith('.xml'):
-                print(f"[DEBUG] {file_name}...")
-                xml_content = zip_file.read(file_name).decode('utf-8')
-                dados = extrair_dados_xml(xml_content)
-                
-                if dados:
-                    tipo = identificar_tipo_nota(dados)
-                    if tipo == 'REMESSA':
-                        print(f"[DEBUG] ⚠️ REMESSA - IGNORADO")
-                        remessas_ignoradas += 1
-                        continue
-                    xmls_dados.append(dados)
-                    valor_total += dados['valor_nf']
-                    quantidade_nfs += 1
+        nomes_xml = [nome for nome in zip_file.namelist() if nome.lower().endswith('.xml')]
+        
+        # O parser consome direto do descompactador, sem materializar cada XML
+        # (lxml leva ~0,1 ms por NFe; distribuir entre processos só atrasa)
+        resultados = (_extrair_xml_do_zip(zip_file, nome) for nome in nomes_xml)
         
-        print(f"[DEBUG] {quantidade_nfs} XMLs, R$ {valor_total:,.2f}")
+        for dados in resultados:
+            if dados:
+                tipo = identificar_tipo_nota(dados)
+                if tipo == 'REMESSA':
+                    log.debug("⚠️ REMESSA - IGNORADO")
+                    remessas_ignoradas += 1
+                    continue
+                xmls_dados.append(dados)
+                valor_total += dados['valor_nf']
+                quantidade_nfs += 1
+        
+        log.debug("%d XMLs, R$ %.2f", quantidade_nfs, valor_total)
         return {'xmls': xmls_dados, 'valor_total': valor_total, 'quantidade': quantidade_nfs, 'remessas_ignoradas': remessas_ignoradas}
     except Exception as e:
-        print(f"[ERRO ZIP] {e}")
+        log.exception("Erro no ZIP: %s", e)
         return None
 
+# Palavras da natureza da operação, em ordem de prioridade
+_NATUREZA_TIPOS = (
+    ('REMESSA', 'REMESSA'),
+    ('IMPORT', 'IMPORTACAO'),
+    ('ENTRADA', 'IMPORTACAO'),
+)
+
 def identificar_tipo_nota(dados):
     natureza = dados['natureza'].upper()
-    if 'REMESSA' in natureza:
-        return 'REMESSA'
-    if 'IMPORT' in natureza or 'ENTRADA' in natureza:
-        return 'IMPORTACAO'
+    for palavra, tipo in _NATUREZA_TIPOS:
+        if palavra in natureza:
+            return tipo
     if dados['cnpj_emitente'] == CNPJ_LDL and dados['cnpj_destinatario'] == CNPJ_POP:
         return 'LDL_PARA_POP'
     elif dados['cnpj_emitente'] == CNPJ_POP:
@@ -388,217 +680,411 @@ def identificar_tipo_nota(dados):
 
 # ==================== GRAVAÇÃO NO SHEETS ====================
 
+def montar_linha_xml(dados, tipo_nota):
+    """Retorna (aba, linha) para gravar a NF, ou None se o tipo não é gravado"""
+    if tipo_nota == 'IMPORTACAO':
+        return 'Importacao', [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['nome_emitente'], dados['cnpj_emitente'],
+                dados['valor_produtos'], dados['valor_nf'], dados['ii'], dados['ipi'], dados['pis'], dados['cofins'],
+                dados['icms'], dados.get('afrmm', 0), dados.get('siscomex', 0)]
+    elif tipo_nota == 'LDL_PARA_POP':
+        return 'Saida_1', [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['valor_nf'], dados['valor_nf'] * 0.004]
+    elif tipo_nota == 'POP_PARA_CLIENTE':
+        return 'Saida_2', [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['nome_destinatario'],
+                dados['cnpj_destinatario'], dados['valor_nf'], dados['natureza']]
+    return None
+
 def gravar_xml_no_sheets(dados, tipo_nota):
     try:
-        planilha = conectar_planilha()
-        if tipo_nota == 'IMPORTACAO':
-            aba = planilha.worksheet('Importacao')
-            linha = [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['nome_emitente'], dados['cnpj_emitente'],
-                    dados['valor_produtos'], dados['valor_nf'], dados['ii'], dados['ipi'], dados['pis'], dados['cofins'],
-                    dados['icms'], dados.get('afrmm', 0), dados.get('siscomex', 0)]
-            aba.append_row(linha)
-            return True
-        elif tipo_nota == 'LDL_PARA_POP':
-            aba = planilha.worksheet('Saida_1')
-            linha = [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['valor_nf'], dados['valor_nf'] * 0.004]
-            aba.append_row(linha)
-            return True
-        elif tipo_nota == 'POP_PARA_CLIENTE':
-            aba = planilha.worksheet('Saida_2')
-            linha = [dados['pi'], dados['numero_nf'], dados['data_emissao'], dados['nome_destinatario'],
-                    dados['cnpj_destinatario'], dados['valor_nf'], dados['natureza']]
-            aba.append_row(linha)
-            return True
-        else:
+        destino = montar_linha_xml(dados, tipo_nota)
+        if not destino:
             return False
+        nome_aba, linha = destino
+        resposta = anexar_linhas(nome_aba, [linha])
+        _registrar_nfs(nome_aba, [(dados['numero_nf'], dados['data_emissao'])], resposta)
+        return True
     except Exception as e:
-        print(f"Erro gravar: {e}")
+        log.exception("Erro gravar: %s", e)
         return False
 
 def gravar_zip_consolidado_no_sheets(pi, zip_resultado, tipo_nota):
     try:
-        planilha = conectar_planilha()
         primeiro = zip_resultado['xmls'][0]
         if tipo_nota == 'POP_PARA_CLIENTE':
-            aba = planilha.worksheet('Saida_2')
             linha = [pi, f"ZIP com {zip_resultado['quantidade']} NFs", primeiro['data_emissao'],
                     primeiro['nome_destinatario'], primeiro['cnpj_destinatario'], zip_resultado['valor_total'], primeiro['natureza']]
         else:
             return False
-        aba.append_row(linha)
+        anexar_linhas('Saida_2', [linha])
         return True
     except Exception as e:
-        print(f"Erro ZIP sheets: {e}")
+        log.exception("Erro ZIP sheets: %s", e)
         return False
 
-def gravar_despesa_no_sheets(pi, categoria, valor, data, descricao, observacao=""):
+def aba_despesas_pronta():
+    """Conexão válida e handle de 'outras_despesas' já em cache (nada a preparar)"""
+    return _conexao_valida() and 'outras_despesas' in _PLANILHA_CACHE['worksheets']
+
+def preparar_aba_despesas():
+    """Garante conexão e handle de 'outras_despesas' antes da gravação (erros ficam para a gravação)"""
     try:
-        planilha = conectar_planilha()
-        try:
-            aba = planilha.worksheet('outras_despesas')
-        except:
-            aba = planilha.add_worksheet(title='outras_despesas', rows=1000, cols=10)
-            aba.append_row(['PI', 'Data', 'Categoria', 'Valor', 'Descrição', 'Observação'])
-        aba.append_row([pi, data, categoria, valor, descricao, observacao])
-        return True
+        obter_aba('outras_despesas')
     except Exception as e:
-        print(f"Erro despesa: {e}")
-        return False
+        log.debug("Aba 'outras_despesas' indisponível: %s", e)
+
+@com_reconexao
+def _gravar_lote_despesas(linhas):
+    """Grava as despesas acumuladas na fila com um único append_rows"""
+    try:
+        aba = obter_aba('outras_despesas')
+    except gspread.exceptions.WorksheetNotFound:
+        aba = conectar_planilha().add_worksheet(title='outras_despesas', rows=1000, cols=10)
+        aba.append_row(['PI', 'Data', 'Categoria', 'Valor', 'Descrição', 'Observação'])
+        _PLANILHA_CACHE['worksheets']['outras_despesas'] = aba
+    resposta = aba.append_rows(linhas)
+    _registrar_despesas(linhas, resposta)
+
+async def loop_gravacao_despesas():
+    """
+    Consome a fila de despesas: junta o que chegar em até ESCRITA_LOTE_INTERVALO
+    segundos (ou ESCRITA_LOTE_MAX itens) e grava tudo numa requisição só.
+    """
+    fila = _FILA_DESPESAS['fila']
+    loop = asyncio.get_running_loop()
+    while True:
+        lote = [await fila.get()]
+        prazo = loop.time() + ESCRITA_LOTE_INTERVALO
+        while len(lote) < ESCRITA_LOTE_MAX:
+            restante = prazo - loop.time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(fila.get(), restante))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await em_sheets(_gravar_lote_despesas, [linha for linha, _ in lote])
+            sucesso = True
+        except Exception as e:
+            log.exception("Erro despesa: %s", e)
+            sucesso = False
+        for _, futuro in lote:
+            if not futuro.done():
+                futuro.set_result(sucesso)
+
+async def gravar_despesa_no_sheets(pi, categoria, valor, data, descricao, observacao=""):
+    """Enfileira a despesa e espera o lote em que ela foi gravada"""
+    futuro = asyncio.get_running_loop().create_future()
+    _FILA_DESPESAS['fila'].put_nowait(([pi, data, categoria, valor, descricao, observacao], futuro))
+    return await futuro
+
+async def iniciar_fila_despesas():
+    _FILA_DESPESAS['fila'] = asyncio.Queue()
+    _FILA_DESPESAS['tarefa'] = asyncio.create_task(loop_gravacao_despesas())
+
+async def parar_fila_despesas():
+    tarefa = _FILA_DESPESAS['tarefa']
+    if tarefa is not None:
+        tarefa.cancel()
+        try:
+            await tarefa
+        except asyncio.CancelledError:
+            pass
+        _FILA_DESPESAS['tarefa'] = None
 
 # ==================== VERIFICAÇÕES DE DUPLICATA ====================
 
 def extrair_pi_da_mensagem(texto):
     if not texto:
         return None
-    texto_upper = texto.upper()
-    for padrao in [r'PI[:\s]*([A-Z0-9]+)', r'PROCESSO[:\s]*([A-Z0-9]+)', r'([A-Z]{4}\d{7})']:
-        match = re.search(padrao, texto_upper)
+    for padrao in _PI_PATTERNS:
+        match = padrao.search(texto)
         if match:
-            return match.group(1)
+            return match.group(1).upper()
+    return None
+
+@com_reconexao
+def carregar_nfs_conhecidas():
+    """Baixa só as colunas B:C (NF e data) das abas de XML em um único batchGet"""
+    planilha = conectar_planilha()
+    # Só as abas que existem: uma aba ausente no batchGet derruba a requisição inteira
+    existentes = [nome_aba for nome_aba in ABAS_XML if nome_aba in _PLANILHA_CACHE['worksheets']]
+    abas = {nome_aba: {} for nome_aba in ABAS_XML}  # aba ausente = nenhuma NF lançada
+    
+    with _NFS_LOCK:
+        resposta = planilha.values_batch_get([f"{nome_aba}!B:C" for nome_aba in existentes]) if existentes else {}
+        
+        for nome_aba, intervalo in zip(existentes, resposta.get('valueRanges', [])):
+            nfs = {}
+            for i, linha in enumerate(intervalo.get('values', [])[1:], start=2):
+                nf_planilha = str(linha[0]).strip() if linha else ''
+                if nf_planilha:
+                    nfs.setdefault(nf_planilha, {'linha': i, 'data': linha[1] if len(linha) > 1 else 'N/A'})
+            abas[nome_aba] = nfs
+        
+        _NFS_CONHECIDAS['abas'] = abas
+        _NFS_CONHECIDAS['carregado_em'] = time.monotonic()
+    return abas
+
+def _registrar_nfs(nome_aba, nfs_datas, resposta):
+    """Adiciona ao índice as NFs recém-gravadas, sem precisar baixar a aba de novo"""
+    primeira_linha = linha_gravada(resposta)
+    with _NFS_LOCK:
+        nfs = _NFS_CONHECIDAS['abas'].get(nome_aba)
+        if nfs is None:
+            return
+        for i, (numero_nf, data) in enumerate(nfs_datas):
+            nf = str(numero_nf).strip()
+            if nf:
+                linha = primeira_linha + i if primeira_linha else 'N/A'
+                nfs.setdefault(nf, {'linha': linha, 'data': data})
+
+def indice_nfs():
+    """Índice de NFs por aba, recarregado quando expira"""
+    abas = _NFS_CONHECIDAS['abas']
+    if not abas or time.monotonic() - _NFS_CONHECIDAS['carregado_em'] > NFS_CACHE_TTL:
+        abas = carregar_nfs_conhecidas()
+    return abas
+
+def nf_lancada(abas, numero_nf):
+    """Retorna (aba, dados) da NF já lançada, ou None"""
+    nf = str(numero_nf).strip()
+    for nome_aba in ABAS_XML:
+        encontrada = abas.get(nome_aba, {}).get(nf)
+        if encontrada:
+            return nome_aba, encontrada
     return None
 
 def verificar_xml_duplicado(numero_nf, cnpj_emitente, valor_nf):
     """Verifica se um XML já foi lançado"""
     try:
-        planilha = conectar_planilha()
-        
-        for nome_aba in ['Importacao', 'Saida_1', 'Saida_2']:
-            try:
-                aba = planilha.worksheet(nome_aba)
-                todas_linhas = aba.get_all_values()
-                
-                for i, linha in enumerate(todas_linhas[1:], start=2):
-                    if not linha or len(linha) < 2:
-                        continue
-                    
-                    nf_planilha = str(linha[1]).strip() if len(linha) > 1 else ''
-                    
-                    if nf_planilha == str(numero_nf).strip():
-                        return {
-                            'duplicada': True,
-                            'aba': nome_aba,
-                            'detalhes': {
-                                'numero_nf': numero_nf,
-                                'linha': i,
-                                'data': linha[2] if len(linha) > 2 else 'N/A'
-                            }
-                        }
-            except:
-                continue
+        lancada = nf_lancada(indice_nfs(), numero_nf)
+        if lancada:
+            nome_aba, encontrada = lancada
+            return {
+                'duplicada': True,
+                'aba': nome_aba,
+                'detalhes': {
+                    'numero_nf': numero_nf,
+                    'linha': encontrada['linha'],
+                    'data': encontrada['data']
+                }
+            }
         
         return {'duplicada': False}
     except Exception as e:
-        print(f"[ERRO verificar_xml] {e}")
+        log.error("Erro em verificar_xml: %s", e)
         return {'duplicada': False}
 
+def _entrada_despesa(numero_linha, linha):
+    """Converte uma linha de 'outras_despesas' no formato usado pela verificação"""
+    data = normalizar_data(str(linha[1]).strip())
+    return {
+        'linha': numero_linha,
+        'data': data,
+        'data_obj': datetime.strptime(data, '%d/%m/%Y'),
+        'categoria': str(linha[2]).strip() if len(linha) > 2 else '',
+        'valor': converter_valor_para_float(str(linha[3]).strip() if len(linha) > 3 else ''),
+    }
+
+@com_reconexao
+def carregar_despesas_por_pi():
+    """Baixa 'outras_despesas' uma vez e indexa as linhas pela PI"""
+    pis = {}
+    try:
+        aba = obter_aba('outras_despesas')
+    except gspread.exceptions.WorksheetNotFound:
+        aba = None
+        log.debug("Aba 'outras_despesas' não existe ainda")
+    
+    with _DESPESAS_LOCK:
+        if aba is not None:
+            for i, linha in enumerate(aba.get_all_values()[1:], start=2):
+                if linha and len(linha) >= 4:
+                    pis.setdefault(str(linha[0]).strip(), []).append(_entrada_despesa(i, linha))
+        
+        _DESPESAS_POR_PI['pis'] = pis
+        _DESPESAS_POR_PI['carregado_em'] = time.monotonic()
+    log.debug("Índice de despesas carregado: %d PI(s)", len(pis))
+    return pis
+
+def despesas_da_pi(pi):
+    """Despesas já lançadas para a PI (o índice só é baixado aqui se ainda não existir)"""
+    pis = _DESPESAS_POR_PI['pis']
+    if pis is None:
+        pis = carregar_despesas_por_pi()
+    return pis.get(str(pi).strip(), [])
+
+def _registrar_despesas(linhas, resposta):
+    """Mantém o índice por PI atualizado com as despesas recém-gravadas"""
+    primeira_linha = linha_gravada(resposta)
+    with _DESPESAS_LOCK:
+        pis = _DESPESAS_POR_PI['pis']
+        if pis is None:
+            return
+        for i, linha in enumerate(linhas):
+            numero = primeira_linha + i if primeira_linha else 'N/A'
+            entradas = pis.setdefault(str(linha[0]).strip(), [])
+            # A recarga pode ter lido a linha logo depois do append; não duplica
+            if primeira_linha and any(e['linha'] == numero for e in entradas):
+                continue
+            entradas.append(_entrada_despesa(numero, linha))
+
+async def atualizar_indice_despesas(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: recarrega o índice de despesas fora do caminho dos cliques"""
+    try:
+        await em_sheets(carregar_despesas_por_pi)
+    except Exception as e:
+        log.error("Erro ao atualizar índice de despesas: %s", e)
+
 def verificar_valor_duplicado_pi(pi, valor, data, categoria=None, dias_margem=100):
     """Verifica se existe valor similar na mesma PI"""
     try:
         data = normalizar_data(data)
-        print(f"[DEBUG] Data normalizada: {data}")
-        print(f"[DEBUG] Valor recebido: {valor} (tipo: {type(valor)})")
-        
-        planilha = conectar_planilha()
-        
-        try:
-            aba = planilha.worksheet('outras_despesas')
-        except:
-            print("[DEBUG] Aba 'outras_despesas' não existe ainda")
-            return {'duplicada': False}
+        log.debug("Data normalizada: %s", data)
+        log.debug("Valor recebido: %r (tipo: %s)", valor, type(valor))
         
-        todas_linhas = aba.get_all_values()
+        despesas = despesas_da_pi(pi)
         
-        if len(todas_linhas) <= 1:
-            print("[DEBUG] Aba vazia, sem duplicatas")
+        if not despesas:
+            log.debug("Nenhum lançamento para esta PI, sem duplicatas")
             return {'duplicada': False}
         
         try:
             data_obj = datetime.strptime(data, '%d/%m/%Y')
-            print(f"[DEBUG] Data convertida: {data_obj}")
+            log.debug("Data convertida: %s", data_obj)
         except Exception as e:
-            print(f"[DEBUG] Erro ao converter data: {e}")
+            log.debug("Erro ao converter data: %s", e)
             data_obj = datetime.now()
         
         data_inicio = data_obj - timedelta(days=dias_margem)
         data_fim = data_obj + timedelta(days=dias_margem)
         
-        print(f"[DEBUG] Procurando duplicatas entre {data_inicio.date()} e {data_fim.date()}")
-        print(f"[DEBUG] PI: {pi}, Valor: {valor}, Categoria: {categoria}")
+        log.debug("Procurando duplicatas entre %s e %s", data_inicio.date(), data_fim.date())
+        log.debug("PI: %s, Valor: %s, Categoria: %s", pi, valor, categoria)
         
         duplicatas_encontradas = []
         
-        for i, linha in enumerate(todas_linhas[1:], start=2):
-            if not linha or len(linha) < 4:
+        for despesa in despesas:
+            if not (data_inicio <= despesa['data_obj'] <= data_fim):
                 continue
             
-            try:
-                pi_planilha = str(linha[0]).strip()
-                data_planilha_str = normalizar_data(str(linha[1]).strip())
-                categoria_planilha = str(linha[2]).strip() if len(linha) > 2 else ''
-                valor_planilha_str = str(linha[3]).strip() if len(linha) > 3 else ''
-                
-                print(f"[DEBUG] Linha {i}: PI={pi_planilha}, Data={data_planilha_str}, Val={valor_planilha_str}")
-                
-                if pi_planilha != str(pi).strip():
-                    continue
-                
-                print(f"[DEBUG] ✓ PI coincide!")
-                
-                valor_planilha = converter_valor_para_float(valor_planilha_str)
-                print(f"[DEBUG] Valor convertido: {valor_planilha}")
-                
-                try:
-                    data_planilha_obj = datetime.strptime(data_planilha_str, '%d/%m/%Y')
-                except Exception as e:
-                    print(f"[DEBUG] Erro ao converter data da planilha: {e}")
-                    continue
-                
-                if not (data_inicio <= data_planilha_obj <= data_fim):
-                    print(f"[DEBUG] Data fora do intervalo")
-                    continue
-                
-                print(f"[DEBUG] ✓ Data dentro do intervalo!")
-                
-                if valor > 0:
-                    diferenca_percentual = abs(valor - valor_planilha) / valor * 100
-                else:
-                    diferenca_percentual = 0
-                
-                print(f"[DEBUG] Diferença: {diferenca_percentual:.2f}%")
-                
-                if diferenca_percentual <= 1:
-                    print(f"[DEBUG] ⚠️ DUPLICATA ENCONTRADA!")
-                    duplicatas_encontradas.append({
-                        'linha': i,
-                        'data': data_planilha_str,
-                        'categoria': categoria_planilha,
-                        'valor': valor_planilha,
-                        'diferenca': diferenca_percentual
-                    })
+            valor_planilha = despesa['valor']
+            if valor > 0:
+                diferenca_percentual = abs(valor - valor_planilha) / valor * 100
+            else:
+                diferenca_percentual = 0
             
-            except Exception as e:
-                print(f"[DEBUG] Erro ao processar linha {i}: {e}")
-                continue
+            if diferenca_percentual <= 1:
+                log.debug("⚠️ Duplicata na linha %s (diferença %.2f%%)", despesa['linha'], diferenca_percentual)
+                duplicatas_encontradas.append({
+                    'linha': despesa['linha'],
+                    'data': despesa['data'],
+                    'categoria': despesa['categoria'],
+                    'valor': valor_planilha,
+                    'diferenca': diferenca_percentual
+                })
         
         if duplicatas_encontradas:
-            print(f"[DEBUG] {len(duplicatas_encontradas)} duplicata(s) encontrada(s)!")
+            log.debug("%d duplicata(s) encontrada(s)!", len(duplicatas_encontradas))
             return {
                 'duplicada': True,
                 'detalhes': duplicatas_encontradas[0],
                 'quantidade': len(duplicatas_encontradas)
             }
         
-        print(f"[DEBUG] Nenhuma duplicata encontrada")
+        log.debug("Nenhuma duplicata encontrada")
         return {'duplicada': False}
     
     except Exception as e:
-        print(f"[ERRO verificar_valor] {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Erro em verificar_valor: %s", e)
         return {'duplicada': False}
 
+async def verificar_despesa_duplicada(pi, valor, data, categoria=None):
+    """Com o índice já carregado a verificação é só memória e roda direto no loop"""
+    if _DESPESAS_POR_PI['pis'] is not None:
+        return verificar_valor_duplicado_pi(pi, valor, data, categoria)
+    return await em_sheets(verificar_valor_duplicado_pi, pi, valor, data, categoria)
+
+# ==================== SESSÃO DO USUÁRIO ====================
+# Os dados temporários de cada upload ficam em context.user_data['sessao'],
+# que o PTB mantém por usuário e grava no PicklePersistence.
+
+def iniciar_sessao(context, dados):
+    dados['atualizado_em'] = time.time()
+    context.user_data['sessao'] = dados
+
+def obter_sessao(context):
+    """Retorna a sessão do usuário, ou None se não houver ou se expirou"""
+    sessao = context.user_data.get('sessao')
+    if sessao is None:
+        return None
+    agora = time.time()
+    if agora - sessao.get('atualizado_em', 0) > SESSAO_TTL:
+        encerrar_sessao(context)
+        return None
+    sessao['atualizado_em'] = agora
+    return sessao
+
+def encerrar_sessao(context):
+    context.user_data.pop('sessao', None)
+
+# Com concurrent_updates ligado, conversas diferentes rodam em paralelo;
+# um lock por usuário mantém a ordem dos cliques/mensagens da mesma pessoa.
+_LOCKS_USUARIO = {}
+
+def por_usuario(handler):
+    """Serializa as execuções do handler para o mesmo usuário"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        lock = _LOCKS_USUARIO.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+async def limpar_sessoes_expiradas(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: descarta sessões abandonadas para não acumularem em memória"""
+    agora = time.time()
+    for user_id, dados_usuario in list(context.application.user_data.items()):
+        sessao = dados_usuario.get('sessao')
+        lock = _LOCKS_USUARIO.get(user_id)
+        if lock is not None and lock.locked():
+            continue  # handler em andamento para esse usuário
+        if sessao is None or agora - sessao.get('atualizado_em', 0) > SESSAO_TTL:
+            context.application.drop_user_data(user_id)
+            _LOCKS_USUARIO.pop(user_id, None)
+    # Locks de usuários que já não têm dados (ex.: restaurados sem sessão)
+    for user_id, lock in list(_LOCKS_USUARIO.items()):
+        if not lock.locked() and user_id not in context.application.user_data:
+            del _LOCKS_USUARIO[user_id]
+
 # ==================== HANDLERS DO TELEGRAM ====================
 
+def _resumo_despesa(pi, categoria, valor, data):
+    return (f"📋 RESUMO\n\nPI: {pi}\nCategoria: {categoria}\n"
+            f"Valor: R$ {valor:,.2f}\nData: {data}\n\nConfirma?")
+
+def _aviso_duplicata_xml(verificacao):
+    detalhes = verificacao['detalhes']
+    return (f"⚠️ POSSÍVEL DUPLICATA!\n\n"
+            f"NF: {detalhes['numero_nf']}\n"
+            f"Data anterior: {detalhes['data']}\n"
+            f"Aba: {verificacao['aba']}\n\n"
+            f"Deseja adicionar mesmo assim?")
+
+def _aviso_duplicata_despesa(dados, detalhes):
+    return (f"⚠️ POSSÍVEL DUPLICATA!\n\n"
+            f"PI: {dados['pi']}\n"
+            f"Valor: R$ {dados['valor_final']:,.2f}\n"
+            f"Categoria: {dados['categoria']}\n\n"
+            f"Já existe lançamento similar:\n"
+            f"Data: {detalhes['data']}\n"
+            f"Valor: R$ {detalhes['valor']:,.2f}\n"
+            f"Categoria: {detalhes['categoria']}\n"
+            f"Diferença: {detalhes['diferenca']:.2f}%\n\n"
+            f"Deseja adicionar mesmo assim?")
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🤖 Bot de Controle de Importação POP+\n\n"
@@ -612,18 +1098,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3. Confirme antes de gravar"
     )
 
+@por_usuario
 async def processar_xml_ou_zip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        user_id = update.effective_user.id
         pi = extrair_pi_da_mensagem(update.message.caption) if update.message.caption else None
         file = await update.message.document.get_file()
         file_bytes = await file.download_as_bytearray()
         file_name = update.message.document.file_name
         
         if file_name.lower().endswith('.zip'):
-            print("[DEBUG] ZIP detectado")
+            log.debug("ZIP detectado")
             msg = await update.message.reply_text("📦 Processando ZIP...")
-            zip_resultado = processar_zip_xmls(file_bytes)
+            zip_resultado = await asyncio.to_thread(processar_zip_xmls, file_bytes)
             
             if not zip_resultado or zip_resultado['quantidade'] == 0:
                 await msg.edit_text("❌ Erro no ZIP ou nenhum XML de venda.")
@@ -641,31 +1127,28 @@ async def processar_xml_ou_zip(update: Update, context: ContextTypes.DEFAULT_TYP
             tipo_map = {'IMPORTACAO': '📦 Importação', 'LDL_PARA_POP': '🔄 LDL→POP+', 'POP_PARA_CLIENTE': '💰 POP+→Cliente'}
             mensagem_remessas = f"\n⚠️ {zip_resultado['remessas_ignoradas']} REMESSAs ignoradas" if zip_resultado.get('remessas_ignoradas', 0) > 0 else ""
             
-            user_data_temp[user_id] = {'tipo': 'zip', 'zip_resultado': zip_resultado, 'tipo_nota': tipo_nota, 'pi': pi}
+            iniciar_sessao(context, {'tipo': 'zip', 'zip_resultado': zip_resultado, 'tipo_nota': tipo_nota, 'pi': pi})
             
             if not pi:
-                keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
                 await msg.edit_text(
                     f"📦 ZIP processado!\n\n"
                     f"Tipo: {tipo_map[tipo_nota]}\n"
                     f"XMLs: {zip_resultado['quantidade']}\n"
                     f"Valor: R$ {zip_resultado['valor_total']:,.2f}{mensagem_remessas}\n\n"
                     f"📝 Informe a PI:\nDigite: PI: YWXS2025115",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=_CANCELAR_KB
                 )
                 return
             
-            keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="confirmar_zip")], [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
             await msg.edit_text(
                 f"📦 ZIP processado!\n\nTipo: {tipo_map[tipo_nota]}\nXMLs: {zip_resultado['quantidade']}\n"
                 f"Valor: R$ {zip_resultado['valor_total']:,.2f}\nPI: {pi}{mensagem_remessas}\n\n"
                 f"⚠️ Será UMA linha. Confirma?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=_CONFIRMAR_ZIP_KB
             )
         else:
-            print("[DEBUG] XML único")
-            xml_content = file_bytes.decode('utf-8')
-            dados = extrair_dados_xml(xml_content, pi)
+            log.debug("XML único")
+            dados = extrair_dados_xml(bytes(file_bytes), pi)
             
             if not dados:
                 await update.message.reply_text("❌ Erro no XML.")
@@ -679,81 +1162,68 @@ async def processar_xml_ou_zip(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("⚠️ Tipo não identificado.")
                 return
             
-            user_data_temp[user_id] = {'tipo': 'xml', 'dados': dados, 'tipo_nota': tipo_nota}
+            iniciar_sessao(context, {'tipo': 'xml', 'dados': dados, 'tipo_nota': tipo_nota})
             
             if not dados['pi'] or dados['pi'] == 'N/A':
-                keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
                 await update.message.reply_text(
                     f"📄 XML processado!\n\nNF: {dados['numero_nf']}\nValor: R$ {dados['valor_nf']:,.2f}\n\n"
                     f"📝 Informe a PI:\nDigite: PI: YWXS2025115",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=_CANCELAR_KB
                 )
                 return
             
             tipo_map = {'IMPORTACAO': '📦 Importação', 'LDL_PARA_POP': '🔄 LDL→POP+', 'POP_PARA_CLIENTE': '💰 POP+→Cliente'}
-            keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="confirmar_xml")], [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
             await update.message.reply_text(
                 f"📄 XML processado!\n\nTipo: {tipo_map[tipo_nota]}\nNF: {dados['numero_nf']}\n"
                 f"Valor: R$ {dados['valor_nf']:,.2f}\nPI: {dados['pi']}\n\nConfirma?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=_CONFIRMAR_XML_KB
             )
     except Exception as e:
-        print(f"[ERRO] {e}")
+        log.exception("Erro ao processar XML/ZIP: %s", e)
         await update.message.reply_text(f"❌ Erro: {str(e)}")
 
+@por_usuario
 async def callback_confirmar_xml(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados_temp = obter_sessao(context)
+    if dados_temp is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    dados_temp = user_data_temp[user_id]
-    
-    verificacao = verificar_xml_duplicado(
+    verificacao = await em_sheets(
+        verificar_xml_duplicado,
         dados_temp['dados']['numero_nf'],
         dados_temp['dados']['cnpj_emitente'],
         dados_temp['dados']['valor_nf']
     )
     
     if verificacao['duplicada']:
-        keyboard = [
-            [InlineKeyboardButton("✅ Adicionar mesmo assim", callback_data="forcar_xml")],
-            [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]
-        ]
-        await query.edit_message_text(
-            f"⚠️ POSSÍVEL DUPLICATA!\n\n"
-            f"NF: {verificacao['detalhes']['numero_nf']}\n"
-            f"Data anterior: {verificacao['detalhes']['data']}\n"
-            f"Aba: {verificacao['aba']}\n\n"
-            f"Deseja adicionar mesmo assim?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        user_data_temp[user_id]['verificacao_duplicata'] = True
+        await query.edit_message_text(_aviso_duplicata_xml(verificacao), reply_markup=_FORCAR_XML_KB)
+        dados_temp['verificacao_duplicata'] = True
         return
     
-    sucesso = gravar_xml_no_sheets(dados_temp['dados'], dados_temp['tipo_nota'])
+    sucesso = await em_sheets(gravar_xml_no_sheets, dados_temp['dados'], dados_temp['tipo_nota'])
     
     if sucesso:
         await query.edit_message_text(f"✅ XML gravado!\n\nNF: {dados_temp['dados']['numero_nf']}\nPI: {dados_temp['dados']['pi']}\n\n📊 Planilha atualizada!")
     else:
         await query.edit_message_text("❌ Erro ao gravar.")
     
-    del user_data_temp[user_id]
+    encerrar_sessao(context)
 
+@por_usuario
 async def callback_forcar_xml(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados_temp = obter_sessao(context)
+    if dados_temp is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    dados_temp = user_data_temp[user_id]
-    sucesso = gravar_xml_no_sheets(dados_temp['dados'], dados_temp['tipo_nota'])
+    sucesso = await em_sheets(gravar_xml_no_sheets, dados_temp['dados'], dados_temp['tipo_nota'])
     
     if sucesso:
         await query.edit_message_text(
@@ -765,26 +1235,26 @@ async def callback_forcar_xml(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         await query.edit_message_text("❌ Erro ao gravar.")
     
-    del user_data_temp[user_id]
+    encerrar_sessao(context)
 
+@por_usuario
 async def callback_confirmar_zip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados_temp = obter_sessao(context)
+    if dados_temp is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    dados_temp = user_data_temp[user_id]
     pi = dados_temp['pi']
     
     if not pi:
         await query.edit_message_text("⚠️ PI não informada! Envie novamente com: PI: YWXS2025115")
-        del user_data_temp[user_id]
+        encerrar_sessao(context)
         return
     
-    sucesso = gravar_zip_consolidado_no_sheets(pi, dados_temp['zip_resultado'], dados_temp['tipo_nota'])
+    sucesso = await em_sheets(gravar_zip_consolidado_no_sheets, pi, dados_temp['zip_resultado'], dados_temp['tipo_nota'])
     
     if sucesso:
         await query.edit_message_text(
@@ -794,19 +1264,18 @@ async def callback_confirmar_zip(update: Update, context: ContextTypes.DEFAULT_T
     else:
         await query.edit_message_text("❌ Erro ao gravar.")
     
-    del user_data_temp[user_id]
+    encerrar_sessao(context)
 
+@por_usuario
 async def callback_cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
-    if user_id in user_data_temp:
-        del user_data_temp[user_id]
+    encerrar_sessao(context)
     await query.edit_message_text("❌ Cancelado.")
 
+@por_usuario
 async def processar_imagem_ou_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        user_id = update.effective_user.id
         pi = extrair_pi_da_mensagem(update.message.caption) if update.message.caption else None
         
         is_pdf = False
@@ -817,65 +1286,64 @@ async def processar_imagem_ou_pdf(update: Update, context: ContextTypes.DEFAULT_
             if update.message.document.mime_type == 'application/pdf':
                 is_pdf = True
         
-        file_bytes = await file.download_as_bytearray()
-        msg = await update.message.reply_text("🔍 Processando...")
-        
-        texto = extrair_texto_imagem(file_bytes, is_pdf)
+        # Baixa direto para o disco: o arquivo não fica inteiro na memória
+        with tempfile.NamedTemporaryFile(suffix='.pdf' if is_pdf else '.img', delete=False) as tmp:
+            caminho = tmp.name
+        # O aviso ao usuário sai enquanto o arquivo ainda está baixando
+        download = asyncio.create_task(file.download_to_drive(caminho))
+        try:
+            msg = await update.message.reply_text("🔍 Processando...")
+            await download
+            # OCR e regex numa thread; as páginas/fotos vão para o _OCR_POOL
+            texto, dados = await asyncio.to_thread(ocr_comprovante, caminho, is_pdf)
+        finally:
+            # Se o aviso falhar, o download não pode recriar o arquivo depois do unlink
+            download.cancel()
+            await asyncio.gather(download, return_exceptions=True)
+            os.unlink(caminho)
         
-        if not texto or len(texto) < 10:
+        if dados is None:
             await msg.edit_text("❌ Não consegui extrair texto.")
             return
         
-        dados = extrair_dados_comprovante(texto)
-        
         if not dados['valores']:
             await msg.edit_text("⚠️ Nenhum valor encontrado.\nUse: /despesa PI 1234.56 Descrição")
             return
         
-        user_data_temp[user_id] = {'tipo': 'comprovante', 'valores': dados['valores'], 'data': dados['data'], 
-                                     'descricao': dados['descricao'], 'pi': pi, 'texto': texto[:500]}
+        iniciar_sessao(context, {'tipo': 'comprovante', 'valores': dados['valores'], 'data': dados['data'],
+                                 'descricao': dados['descricao'], 'pi': pi, 'texto': texto[:500]})
         
         valores_str = "\n".join([f"• R$ {v:,.2f}" for v in dados['valores'][:5]])
-        keyboard = []
-        for i in range(0, len(CATEGORIAS_DESPESAS), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(CATEGORIAS_DESPESAS):
-                    row.append(InlineKeyboardButton(CATEGORIAS_DESPESAS[i+j], callback_data=f"cat_{i+j}"))
-            keyboard.append(row)
-        
         await msg.edit_text(
             f"📄 Processado!\n\nValores:\n{valores_str}\n\nData: {dados['data']}\n"
             f"Tipo: {dados['descricao']}\nPI: {pi or 'Não informada'}\n\n👇 Categoria:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_CAT_KEYBOARD
         )
     except Exception as e:
-        print(f"[ERRO] {e}")
+        log.exception("Erro ao processar imagem/PDF: %s", e)
         await update.message.reply_text(f"❌ Erro: {str(e)}")
 
+@por_usuario
 async def callback_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
     cat_index = int(query.data.split('_')[1])
     categoria = CATEGORIAS_DESPESAS[cat_index]
-    user_data_temp[user_id]['categoria'] = categoria
+    dados['categoria'] = categoria
     
     if categoria == "Outros":
-        keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
-        await query.edit_message_text(f"📝 'Outros' selecionado\n\nDigite descrição:\n(ex: Taxa alfandegária)", reply_markup=InlineKeyboardMarkup(keyboard))
-        user_data_temp[user_id]['aguardando_descricao_outros'] = True
+        await query.edit_message_text(f"📝 'Outros' selecionado\n\nDigite descrição:\n(ex: Taxa alfandegária)", reply_markup=_CANCELAR_KB)
+        dados['aguardando_descricao_outros'] = True
         return
     
-    dados = user_data_temp[user_id]
     if not dados.get('pi'):
-        keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
-        await query.edit_message_text(f"✅ Categoria: {categoria}\n\n📝 Informe PI:\nDigite: PI: YWXS2025115", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text(f"✅ Categoria: {categoria}\n\n📝 Informe PI:\nDigite: PI: YWXS2025115", reply_markup=_CANCELAR_KB)
         return
     
     if len(dados['valores']) > 1:
@@ -883,7 +1351,7 @@ async def callback_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE)
         for i, v in enumerate(dados['valores']):
             keyboard.append([InlineKeyboardButton(f"R$ {v:,.2f}", callback_data=f"val_{i}")])
         
-        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")])
+        keyboard.append([_BOTAO_CANCELAR])
         keyboard.append([InlineKeyboardButton("📝 Digitar outro valor", callback_data="digitar_valor")])
         
         valores_encontrados = f"\n✅ {len(dados['valores'])} valores encontrados:\n"
@@ -894,136 +1362,113 @@ async def callback_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         valor = dados['valores'][0]
         categoria_exibir = f"Outros - {dados.get('categoria_personalizada', '')}" if categoria == "Outros" else categoria
-        keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="confirmar_despesa")], [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
         dados['valor_final'] = valor
         await query.edit_message_text(
-            f"📋 RESUMO\n\nPI: {dados['pi']}\nCategoria: {categoria_exibir}\n"
-            f"Valor: R$ {valor:,.2f}\nData: {dados['data']}\n\nConfirma?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            _resumo_despesa(dados['pi'], categoria_exibir, valor, dados['data']),
+            reply_markup=_CONFIRMAR_DESPESA_KB
         )
 
+@por_usuario
 async def callback_digitar_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    user_data_temp[user_id]['aguardando_valor_manual'] = True
-    keyboard = [[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
+    dados['aguardando_valor_manual'] = True
     await query.edit_message_text(
         "💰 Digite o valor (ex: 1234.56 ou 1234,56):",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=_CANCELAR_KB
     )
 
+@por_usuario
 async def callback_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
     val_index = int(query.data.split('_')[1])
-    dados = user_data_temp[user_id]
     valor = dados['valores'][val_index]
     dados['valor_final'] = valor
     
     categoria = dados.get('categoria_personalizada', dados['descricao']) if dados['categoria'] == "Outros" else dados['categoria']
-    keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="confirmar_despesa")], [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
     await query.edit_message_text(
-        f"📋 RESUMO\n\nPI: {dados['pi']}\nCategoria: {categoria}\n"
-        f"Valor: R$ {valor:,.2f}\nData: {dados['data']}\n\nConfirma?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        _resumo_despesa(dados['pi'], categoria, valor, dados['data']),
+        reply_markup=_CONFIRMAR_DESPESA_KB
     )
 
+@por_usuario
 async def callback_confirmar_despesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
     
-    print(f"[DEBUG] callback_confirmar_despesa acionado para user {user_id}")
+    log.debug("callback_confirmar_despesa acionado para user %s", user_id)
     
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    dados = user_data_temp[user_id]
-    
-    print(f"[DEBUG] Dados: {dados}")
-    print(f"[DEBUG] Verificando duplicata para: PI={dados['pi']}, Valor={dados['valor_final']}, Data={dados['data']}")
+    log.debug("Dados: %s", dados)
+    log.debug("Verificando duplicata para: PI=%s, Valor=%s, Data=%s", dados['pi'], dados['valor_final'], dados['data'])
     
     data_normalizada = normalizar_data(dados['data'])
-    print(f"[DEBUG] Data normalizada: {data_normalizada}")
+    log.debug("Data normalizada: %s", data_normalizada)
     
-    verificacao = verificar_valor_duplicado_pi(
-        dados['pi'],
-        dados['valor_final'],
-        data_normalizada,
-        dados['categoria']
-    )
+    verificacao = verificar_despesa_duplicada(dados['pi'], dados['valor_final'], data_normalizada, dados['categoria'])
+    if aba_despesas_pronta():
+        verificacao = await verificacao
+    else:
+        # Reconexão/abertura da aba corre junto com a verificação; a gravação só paga o append
+        verificacao, _ = await asyncio.gather(verificacao, em_sheets(preparar_aba_despesas))
     
-    print(f"[DEBUG] Resultado: {verificacao}")
+    log.debug("Resultado: %s", verificacao)
     
     if verificacao['duplicada']:
-        print(f"[DEBUG] DUPLICATA ENCONTRADA!")
-        keyboard = [
-            [InlineKeyboardButton("✅ Adicionar mesmo assim", callback_data="forcar_despesa")],
-            [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]
-        ]
-        
-        detalhes = verificacao['detalhes']
-        await query.edit_message_text(
-            f"⚠️ POSSÍVEL DUPLICATA!\n\n"
-            f"PI: {dados['pi']}\n"
-            f"Valor: R$ {dados['valor_final']:,.2f}\n"
-            f"Categoria: {dados['categoria']}\n\n"
-            f"Já existe lançamento similar:\n"
-            f"Data: {detalhes['data']}\n"
-            f"Valor: R$ {detalhes['valor']:,.2f}\n"
-            f"Categoria: {detalhes['categoria']}\n"
-            f"Diferença: {detalhes['diferenca']:.2f}%\n\n"
-            f"Deseja adicionar mesmo assim?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        log.debug("DUPLICATA ENCONTRADA!")
+        await query.edit_message_text(_aviso_duplicata_despesa(dados, verificacao['detalhes']), reply_markup=_FORCAR_DESPESA_KB)
         return
     
-    print(f"[DEBUG] Sem duplicata, gravando...")
+    log.debug("Sem duplicata, gravando...")
     
     if dados['categoria'] == "Outros":
         descricao = dados.get('categoria_personalizada', dados['descricao'])
     else:
         descricao = dados['categoria']
     
-    sucesso = gravar_despesa_no_sheets(dados['pi'], dados['categoria'], dados['valor_final'], data_normalizada, descricao)
+    sucesso = await gravar_despesa_no_sheets(dados['pi'], dados['categoria'], dados['valor_final'], data_normalizada, descricao)
     
     if sucesso:
         await query.edit_message_text(f"✅ Despesa gravada!\n\nPI: {dados['pi']}\nValor: R$ {dados['valor_final']:,.2f}\n\n📊 Planilha atualizada!")
     else:
         await query.edit_message_text("❌ Erro ao gravar.")
     
-    del user_data_temp[user_id]
+    encerrar_sessao(context)
 
+@por_usuario
 async def callback_forcar_despesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = update.effective_user.id
     
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         await query.edit_message_text("❌ Dados expirados.")
         return
     
-    dados = user_data_temp[user_id]
-    
     if dados['categoria'] == "Outros":
         descricao = dados.get('categoria_personalizada', dados['descricao'])
     else:
         descricao = dados['categoria']
     
-    sucesso = gravar_despesa_no_sheets(dados['pi'], dados['categoria'], dados['valor_final'], dados['data'], descricao)
+    sucesso = await gravar_despesa_no_sheets(dados['pi'], dados['categoria'], dados['valor_final'], dados['data'], descricao)
     
     if sucesso:
         await query.edit_message_text(
@@ -1034,15 +1479,15 @@ async def callback_forcar_despesa(update: Update, context: ContextTypes.DEFAULT_
     else:
         await query.edit_message_text("❌ Erro ao gravar.")
     
-    del user_data_temp[user_id]
+    encerrar_sessao(context)
 
+@por_usuario
 async def processar_mensagem_texto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in user_data_temp:
+    dados = obter_sessao(context)
+    if dados is None:
         return
     
     texto = update.message.text.strip()
-    dados = user_data_temp[user_id]
     
     if dados.get('aguardando_valor_manual'):
         try:
@@ -1051,11 +1496,9 @@ async def processar_mensagem_texto(update: Update, context: ContextTypes.DEFAULT
             dados['aguardando_valor_manual'] = False
             
             categoria = dados.get('categoria_personalizada', dados['descricao']) if dados['categoria'] == "Outros" else dados['categoria']
-            keyboard = [[InlineKeyboardButton("✅ Confirmar", callback_data="confirmar_despesa")], [InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]
             await update.message.reply_text(
-                f"📋 RESUMO\n\nPI: {dados['pi']}\nCategoria: {categoria}\n"
-                f"Valor: R$ {valor:,.2f}\nData: {dados['data']}\n\nConfirma?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                _resumo_despesa(dados['pi'], categoria, valor, dados['data']),
+                reply_markup=_CONFIRMAR_DESPESA_KB
             )
             return
         except:
@@ -1075,17 +1518,9 @@ async def processar_mensagem_texto(update: Update, context: ContextTypes.DEFAULT
     if pi:
         dados['pi'] = pi
         
-        keyboard = []
-        for i in range(0, len(CATEGORIAS_DESPESAS), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(CATEGORIAS_DESPESAS):
-                    row.append(InlineKeyboardButton(CATEGORIAS_DESPESAS[i+j], callback_data=f"cat_{i+j}"))
-            keyboard.append(row)
-        
         await update.message.reply_text(
             f"✅ PI definida: {pi}\n\n👇 Agora selecione a categoria:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_CAT_KEYBOARD
         )
     else:
         await update.message.reply_text("⚠️ PI não identificada. Use: PI: YWXS2025115")
@@ -1100,14 +1535,10 @@ async def comando_despesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
         valor = float(context.args[1].replace(',', '.'))
         descricao = ' '.join(context.args[2:])
         data = datetime.now().strftime('%d/%m/%Y')
-        categoria = "Outros"
-        
-        for cat in CATEGORIAS_DESPESAS[:-1]:
-            if cat.upper() in descricao.upper():
-                categoria = cat
-                break
+        descricao_upper = descricao.upper()
+        categoria = next((cat for cat, cat_upper in _CATEGORIAS_UPPER if cat_upper in descricao_upper), "Outros")
         
-        if gravar_despesa_no_sheets(pi, categoria, valor, data, descricao):
+        if await gravar_despesa_no_sheets(pi, categoria, valor, data, descricao):
             await update.message.reply_text(f"✅ Despesa lançada!\n\nPI: {pi}\nValor: R$ {valor:,.2f}\nCategoria: {categoria}\n\n📊 Planilha atualizada!")
         else:
             await update.message.reply_text("❌ Erro ao gravar.")
@@ -1116,7 +1547,7 @@ async def comando_despesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        planilha = conectar_planilha()
+        planilha = await em_sheets(conectar_planilha)
         await update.message.reply_text(
             f"📊 Status\n\n✅ Bot online\n✅ Google Sheets: {planilha.title}\n✅ OCR OK\n✅ ZIP OK\n\n"
             "Comandos:\n/start - Instruções\n/despesa - Lançar manual\n/info - Status"
@@ -1126,19 +1557,48 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== MAIN ====================
 
+async def ao_iniciar(app):
+    """Sobe as tarefas de fundo assim que o event loop do bot está rodando"""
+    await iniciar_fila_despesas()
+
+async def ao_parar(app):
+    await parar_fila_despesas()
+
 def main():
+    # LOG_LEVEL=DEBUG/INFO liga o rastreio detalhado; em produção fica WARNING
+    nivel = logging.getLevelName(os.getenv("LOG_LEVEL", "WARNING").upper())
+    if not isinstance(nivel, int):  # valor desconhecido: getLevelName devolve "Level X"
+        nivel = logging.WARNING
+    logging.basicConfig(level=nivel, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    # httpx loga cada chamada à API do Telegram em INFO com a URL completa, que contém o token;
+    # o apscheduler loga cada execução dos jobs periódicos
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    
     PORT = int(os.environ.get("PORT", 10000))
     WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL")
 
     if not WEBHOOK_URL:
         raise RuntimeError("❌ RENDER_EXTERNAL_URL não definida")
 
+    persistence = PicklePersistence(
+        filepath=PERSISTENCE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+    )
     app = (
         Application.builder()
         .token(TELEGRAM_TOKEN)
-        .concurrent_updates(False)
+        .persistence(persistence)
+        # Respeita os limites do Telegram (global e por chat) em todos os envios/edições
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .concurrent_updates(256)
+        .post_init(ao_iniciar)
+        .post_stop(ao_parar)
         .build()
     )
+    app.job_queue.run_repeating(limpar_sessoes_expiradas, interval=60, first=60)
+    # first=0: o índice já fica pronto logo que o bot sobe
+    app.job_queue.run_repeating(atualizar_indice_despesas, interval=DESPESAS_REFRESH_INTERVALO, first=0)
 
     # Handlers
     app.add_handler(CommandHandler("start", start))
@@ -1165,17 +1625,16 @@ def main():
     app.add_handler(CallbackQueryHandler(callback_valor, pattern="^val_"))
     app.add_handler(CallbackQueryHandler(callback_digitar_valor, pattern="^digitar_valor$"))
 
-    print("🤖 Bot iniciado em modo WEBHOOK")
-    print(f"🌐 URL pública: {WEBHOOK_URL}")
-    print(f"🔗 Registrando webhook em: {WEBHOOK_URL}/{TELEGRAM_TOKEN}")
+    log.info("🤖 Bot iniciado em modo WEBHOOK")
+    log.info("🌐 URL pública: %s", WEBHOOK_URL)
+    log.info("🔗 Registrando webhook em: %s/<token>", WEBHOOK_URL)
 
-    # Testar conexão ao iniciar
+    # Conecta já na subida: testa as credenciais e deixa o primeiro usuário sem o custo da autenticação
     try:
-        planilha = conectar_planilha()
-        print(f"✅ Conectado à planilha: {planilha.title}")
+        conectar_planilha()
     except Exception as e:
-        print(f"❌ ERRO ao conectar planilha: {e}")
-        print("⚠️ Verifique as credenciais e o ID da planilha")
+        log.error("❌ ERRO ao conectar planilha: %s", e)
+        log.warning("⚠️ Verifique as credenciais e o ID da planilha")
 
     app.run_webhook(
         listen="0.0.0.0",
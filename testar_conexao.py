@@ -6,7 +6,7 @@ Execute: python testar_conexao.py
 """
 
 import os
-import json
+import orjson
 from google.oauth2.service_account import Credentials
 import gspread
 from dotenv import load_dotenv
@@ -53,11 +53,11 @@ def testar_credenciais():
     if credentials_json:
         print("   📄 Usando CREDENTIALS_JSON da variável de ambiente")
         try:
-            creds_dict = json.loads(credentials_json)
+            creds_dict = orjson.loads(credentials_json)
             creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
             print("   ✅ Credenciais carregadas com sucesso")
             print(f"   📧 Service Account: {creds_dict.get('client_email', 'N/A')}")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"   ❌ Erro ao parsear JSON: {e}")
             return False
         except Exception as e:
@@ -69,8 +69,8 @@ def testar_credenciais():
         print("   📄 Usando arquivo credentials.json local")
         try:
             creds = Credentials.from_service_account_file("credentials.json", scopes=scopes)
-            with open("credentials.json") as f:
-                creds_dict = json.load(f)
+            with open("credentials.json", "rb") as f:
+                creds_dict = orjson.loads(f.read())
             print("   ✅ Credenciais carregadas com sucesso")
             print(f"   📧 Service Account: {creds_dict.get('client_email', 'N/A')}")
         except Exception as e: